@@ -3,11 +3,17 @@ import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, MessageHandler, ChatMemberHandler, CallbackQueryHandler, CommandHandler, filters, ContextTypes
 from telegram.constants import ChatMemberStatus
+from telegram.request import HTTPXRequest
 import asyncio
-from flask import Flask
-import threading
+import signal
+from aiohttp import web
 import time
 
+try:
+    import uvloop
+except ImportError:  # uvloop is unavailable on Windows
+    uvloop = None
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,16 +21,52 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Flask app for Koyeb health checks
-app = Flask(__name__)
+# Port Koyeb routes traffic to, fixed for the life of the process
+PORT = int(os.environ.get('PORT', 8000))
+
+# Chat member statuses for detecting a member leaving the group
+_JOINED_STATUSES = frozenset({ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+_LEFT_STATUSES = frozenset({ChatMemberStatus.LEFT, ChatMemberStatus.BANNED})
+
+# Update types we handle: "message" for joins and /start, "chat_member" for leaves
+ALLOWED_UPDATES = ["message", "chat_member"]
+
+# Message templates, formatted per member
+LEAVE_DM_TEMPLATE = (
+    "Hi {name}! 👋\n\n"
+    "I noticed you left our group. We're sorry to see you go! 😢\n\n"
+    "Would you mind sharing why you decided to leave? Your feedback would help us improve the group experience for everyone.\n\n"
+    "Thanks for taking the time to let us know! 🙏"
+)
+
+GROUP_FALLBACK_TEMPLATE = (
+    "👋 {mention}, we're sorry to see you go! 😢\n\n"
+    "If you'd like to share why you left our group, please send me a private message. "
+    "Your feedback helps us improve the community for everyone! 🙏\n\n"
+    "Thanks for being part of our group! ✨"
+)
+
+WELCOME_TEMPLATE = (
+    "🎉 Welcome to our group, {name}! \n\n"
+    "👋 Please click the button below to say hi to our bot. This helps us "
+    "reach out for feedback if you ever decide to leave the group.\n\n"
+    "Thanks for joining our community! ✨"
+)
+
+START_REPLY_TEMPLATE = (
+    "Hi {name}! 👋\n\n"
+    "Thanks for saying hello! Now I can reach out to you if you ever leave our group "
+    "to get your valuable feedback. 😊\n\n"
+    "Your input helps us make the community better for everyone! 🙏\n\n"
+    "Feel free to message me anytime if you have suggestions or feedback about the group! ✨"
+)
 
-@app.route('/')
-def health_check():
-    return "Telegram Leave Bot is running! 🤖", 200
+# Health check routes for Koyeb, served on the bot's event loop
+async def health_check(request: web.Request) -> web.Response:
+    return web.Response(text="Telegram Leave Bot is running! 🤖")
 
-@app.route('/health')
-def health():
-    return {"status": "healthy", "service": "telegram-leave-bot"}, 200
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "healthy", "service": "telegram-leave-bot"})
 
 class TelegramLeaveBot:
     def __init__(self, bot_token: str, group_chat_id: int):
@@ -37,238 +79,213 @@ class TelegramLeaveBot:
         """
         self.bot_token = bot_token
         self.group_chat_id = group_chat_id
-        self.application = Application.builder().token(bot_token).build()
+        # Multiplex API calls over a pooled HTTP/2 connection to api.telegram.org
+        request = HTTPXRequest(
+            connection_pool_size=64,
+            http_version="2",
+            read_timeout=10,
+            write_timeout=10,
+            pool_timeout=1
+        )
+        # Process updates concurrently so one slow send_message doesn't hold up the rest
+        self.application = (
+            Application.builder()
+            .token(bot_token)
+            .request(request)
+            .get_updates_request(HTTPXRequest(http_version="2"))
+            .concurrent_updates(True)
+            .build()
+        )
+        
+        # Only dispatch updates from our target group to the join handler
+        group_filter = filters.Chat(group_chat_id)
+        
+        # Build handlers and their filters once; setup_handlers registers them
+        self._handlers = [
+            # Handler for new members joining
+            MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS & group_filter, self.handle_new_member, block=False),
+            # Handler for /start command in private chat
+            CommandHandler("start", self.handle_start_command),
+            # Handler for callback queries from inline buttons
+            CallbackQueryHandler(self.handle_callback_query),
+            # Handler for chat member updates - the only leave detection path
+            ChatMemberHandler(self.handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER, block=False),
+        ]
         
-    async def handle_member_left(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle when a member leaves the group"""
-        try:
-            # Check if this update is from our target group
-            if update.effective_chat.id != self.group_chat_id:
-                return
-                
-            # Check if someone left the chat
-            if update.message and update.message.left_chat_member:
-                left_member = update.message.left_chat_member
-                
-                # Don't send message if bot itself left or if it's a bot
-                if left_member.is_bot:
-                    logger.info(f"Bot {left_member.username} left the group")
-                    return
-                    
-                logger.info(f"Member {left_member.full_name} (@{left_member.username}) left the group")
-                
-                # Try to send private message first, fallback to group mention
-                try:
-                    await context.bot.send_message(
-                        chat_id=left_member.id,
-                        text=f"Hi {left_member.first_name}! 👋\n\n"
-                             f"I noticed you left our group. We're sorry to see you go! 😢\n\n"
-                             f"Would you mind sharing why you decided to leave? Your feedback would help us improve the group experience for everyone.\n\n"
-                             f"Thanks for taking the time to let us know! 🙏"
-                    )
-                    logger.info(f"Successfully sent private leave message to {left_member.full_name}")
-                    
-                except Exception as e:
-                    logger.info(f"Couldn't send private message to {left_member.full_name}, sending group mention instead")
-                    # Fallback to group mention
-                    try:
-                        username_mention = f"@{left_member.username}" if left_member.username else left_member.first_name
-                        await context.bot.send_message(
-                            chat_id=self.group_chat_id,
-                            text=f"👋 {username_mention}, we're sorry to see you go! 😢\n\n"
-                                 f"If you'd like to share why you left our group, please send me a private message. "
-                                 f"Your feedback helps us improve the community for everyone! 🙏\n\n"
-                                 f"Thanks for being part of our group! ✨"
-                        )
-                        logger.info(f"Successfully sent group mention for {left_member.full_name}")
-                        
-                    except Exception as e2:
-                        logger.error(f"Failed to send group message for {left_member.full_name}: {e2}")
-                    
-        except Exception as e:
-            logger.error(f"Error in handle_member_left: {e}")
-    
     async def handle_new_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle when new members join the group"""
-        try:
-            # Check if this update is from our target group
-            if update.effective_chat.id != self.group_chat_id:
-                return
-                
-            # Check if someone joined the chat
-            if update.message and update.message.new_chat_members:
-                for new_member in update.message.new_chat_members:
-                    # Don't welcome bots
-                    if new_member.is_bot:
-                        continue
-                        
-                    logger.info(f"New member {new_member.full_name} (@{new_member.username}) joined the group")
-                    
-                    # Create inline keyboard with button to start chat with bot
-                    keyboard = [
-                        [InlineKeyboardButton("👋 Say Hi to Bot", url=f"https://t.me/{context.bot.username}?start=hello")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    try:
-                        await context.bot.send_message(
-                            chat_id=self.group_chat_id,
-                            text=f"🎉 Welcome to our group, {new_member.first_name}! \n\n"
-                                 f"👋 Please click the button below to say hi to our bot. This helps us "
-                                 f"reach out for feedback if you ever decide to leave the group.\n\n"
-                                 f"Thanks for joining our community! ✨",
-                            reply_markup=reply_markup
-                        )
-                        logger.info(f"Successfully sent welcome message for {new_member.full_name}")
-                        
-                    except Exception as e:
-                        logger.error(f"Failed to send welcome message for {new_member.full_name}: {e}")
-                        
-        except Exception as e:
-            logger.error(f"Error in handle_new_member: {e}")
-    
-    async def handle_start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command when users message the bot privately"""
-        try:
-            user = update.effective_user
-            logger.info(f"User {user.full_name} (@{user.username}) started a conversation with the bot")
+        # Check if someone joined the chat
+        if update.message and update.message.new_chat_members:
+            # Don't welcome bots
+            new_members = [m for m in update.message.new_chat_members if not m.is_bot]
+            
+            for new_member in new_members:
+                logger.info("New member %s (@%s) joined the group", new_member.full_name, new_member.username)
             
-            await update.message.reply_text(
-                f"Hi {user.first_name}! 👋\n\n"
-                f"Thanks for saying hello! Now I can reach out to you if you ever leave our group "
-                f"to get your valuable feedback. 😊\n\n"
-                f"Your input helps us make the community better for everyone! 🙏\n\n"
-                f"Feel free to message me anytime if you have suggestions or feedback about the group! ✨"
+            # Send all welcome messages concurrently so a mass join costs ~1 round-trip
+            results = await asyncio.gather(
+                *(
+                    context.bot.send_message(
+                        chat_id=self.group_chat_id,
+                        text=WELCOME_TEMPLATE.format(name=new_member.first_name),
+                        reply_markup=self._welcome_markup
+                    )
+                    for new_member in new_members
+                ),
+                return_exceptions=True
             )
             
-        except Exception as e:
-            logger.error(f"Error in handle_start_command: {e}")
+            for new_member, result in zip(new_members, results):
+                if isinstance(result, Exception):
+                    logger.error("Failed to send welcome message for %s: %s", new_member.full_name, result)
+                else:
+                    logger.info("Successfully sent welcome message for %s", new_member.full_name)
+    
+    async def handle_start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command when users message the bot privately"""
+        user = update.effective_user
+        logger.info("User %s (@%s) started a conversation with the bot", user.full_name, user.username)
+        
+        await update.message.reply_text(START_REPLY_TEMPLATE.format(name=user.first_name))
 
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle callback queries from inline buttons"""
-        try:
-            query = update.callback_query
-            await query.answer()
+        query = update.callback_query
+        await query.answer()
+        
+        if query.data == "start_chat":
+            user = query.from_user
+            logger.info("User %s clicked the start chat button", user.full_name)
             
-            if query.data == "start_chat":
-                user = query.from_user
-                logger.info(f"User {user.full_name} clicked the start chat button")
-                
-                await query.edit_message_text(
-                    text=f"✅ Great! {user.first_name}, you can now receive feedback requests from our bot.\n\n"
-                         f"Click the button below to start a private chat:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("💬 Start Private Chat", url=f"https://t.me/{context.bot.username}?start=hello")]
-                    ])
-                )
-                
-        except Exception as e:
-            logger.error(f"Error in handle_callback_query: {e}")
-        """Handle chat member status updates (alternative method)"""
-        try:
-            if not update.chat_member or update.effective_chat.id != self.group_chat_id:
+            await query.edit_message_text(
+                text=f"✅ Great! {user.first_name}, you can now receive feedback requests from our bot.\n\n"
+                     f"Click the button below to start a private chat:",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("💬 Start Private Chat", url=self._start_url)]
+                ])
+            )
+    
+    async def handle_chat_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle chat member status updates"""
+        # ChatMemberHandler has no chat filter, so check the group here
+        if not update.chat_member or update.chat_member.chat.id != self.group_chat_id:
+            return
+            
+        old_status = update.chat_member.old_chat_member.status
+        new_status = update.chat_member.new_chat_member.status
+        user = update.chat_member.new_chat_member.user
+        
+        # Check if member left (was member/admin/owner, now left/kicked)
+        if old_status in _JOINED_STATUSES and new_status in _LEFT_STATUSES:
+            
+            if user.is_bot:
                 return
                 
-            old_status = update.chat_member.old_chat_member.status
-            new_status = update.chat_member.new_chat_member.status
-            user = update.chat_member.new_chat_member.user
+            logger.info("Member %s (@%s) status changed from %s to %s", user.full_name, user.username, old_status, new_status)
             
-            # Check if member left (was member/admin/owner, now left/kicked)
-            if (old_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER] and 
-                new_status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]):
-                
-                if user.is_bot:
-                    return
-                    
-                logger.info(f"Member {user.full_name} (@{user.username}) status changed from {old_status} to {new_status}")
+            try:
+                await context.bot.send_message(
+                    chat_id=user.id,
+                    text=LEAVE_DM_TEMPLATE.format(name=user.first_name)
+                )
+                logger.info("Successfully sent private leave message to %s", user.full_name)
                 
+            except Exception:
+                logger.info("Couldn't send private message to %s, sending group mention instead", user.full_name)
+                # Fallback to group mention
                 try:
+                    username_mention = f"@{user.username}" if user.username else user.first_name
                     await context.bot.send_message(
-                        chat_id=user.id,
-                        text=f"Hi {user.first_name}! 👋\n\n"
-                             f"I noticed you left our group. We're sorry to see you go! 😢\n\n"
-                             f"Would you mind sharing why you decided to leave? Your feedback would help us improve the group experience for everyone.\n\n"
-                             f"Thanks for taking the time to let us know! 🙏"
+                        chat_id=self.group_chat_id,
+                        text=GROUP_FALLBACK_TEMPLATE.format(mention=username_mention)
                     )
-                    logger.info(f"Successfully sent private leave message to {user.full_name}")
-                    
-                except Exception as e:
-                    logger.info(f"Couldn't send private message to {user.full_name}, sending group mention instead")
-                    # Fallback to group mention
-                    try:
-                        username_mention = f"@{user.username}" if user.username else user.first_name
-                        await context.bot.send_message(
-                            chat_id=self.group_chat_id,
-                            text=f"👋 {username_mention}, we're sorry to see you go! 😢\n\n"
-                                 f"If you'd like to share why you left our group, please send me a private message. "
-                                 f"Your feedback helps us improve the community for everyone! 🙏\n\n"
-                                 f"Thanks for being part of our group! ✨"
-                        )
-                        logger.info(f"Successfully sent group mention for {user.full_name}")
-                        
-                    except Exception as e2:
-                        logger.error(f"Failed to send group message for {user.full_name}: {e2}")
+                    logger.info("Successfully sent group mention for %s", user.full_name)
                     
-        except Exception as e:
-            logger.error(f"Error in handle_chat_member_update: {e}")
+                except Exception:
+                    logger.exception("Failed to send group message for %s", user.full_name)
+    
+    async def handle_error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """Log exceptions raised by any handler"""
+        logger.error("Error while handling update %s", update, exc_info=context.error)
     
     def setup_handlers(self):
         """Setup message handlers"""
-        # Handler for new members joining
-        self.application.add_handler(
-            MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, self.handle_new_member)
-        )
+        for handler in self._handlers:
+            self.application.add_handler(handler)
         
-        # Handler for /start command in private chat
-        self.application.add_handler(
-            CommandHandler("start", self.handle_start_command)
-        )
-        
-        # Handler for callback queries from inline buttons
-        self.application.add_handler(
-            CallbackQueryHandler(self.handle_callback_query)
-        )
-        
-        # Handler for left_chat_member messages
-        self.application.add_handler(
-            MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, self.handle_member_left)
-        )
-        
-        # Handler for chat member updates (more reliable) - using ChatMemberHandler
-        self.application.add_handler(
-            ChatMemberHandler(self.handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER)
-        )
+        # Single error path for all handlers
+        self.application.add_error_handler(self.handle_error)
     
-    async def start_bot(self):
-        """Start the bot using webhooks for Koyeb"""
+    async def start_bot(self, webhook_host: str = None, port: int = PORT):
+        """
+        Start the bot using webhooks for Koyeb
+        
+        Args:
+            webhook_host: Public hostname Telegram should push updates to.
+                          Falls back to polling when not set.
+            port: Port the webhook server listens on
+        """
         self.setup_handlers()
         await self.application.initialize()
+        
+        # initialize() already fetched get_me, so build the start link and
+        # welcome keyboard once instead of per joining member
+        self._start_url = f"https://t.me/{self.application.bot.username}?start=hello"
+        self._welcome_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("👋 Say Hi to Bot", url=self._start_url)]
+        ])
+        
         await self.application.start()
-        await self.application.updater.start_polling(allowed_updates=["message", "chat_member"])
-        logger.info("Bot started successfully!")
+        if webhook_host:
+            await self.application.updater.start_webhook(
+                listen="0.0.0.0",
+                port=port,
+                url_path=self.bot_token,
+                webhook_url=f"https://{webhook_host}/{self.bot_token}",
+                allowed_updates=ALLOWED_UPDATES
+            )
+            logger.info(f"Bot started successfully with webhook on https://{webhook_host}/...")
+        else:
+            # Long-poll for up to 30s per getUpdates instead of the short default
+            await self.application.updater.start_polling(
+                allowed_updates=ALLOWED_UPDATES,
+                poll_interval=0.0,
+                timeout=30,
+                bootstrap_retries=-1,
+                drop_pending_updates=True
+            )
+            logger.info("Bot started successfully!")
 
-def run_flask():
-    """Run Flask server in a separate thread"""
-    port = int(os.environ.get('PORT', 8000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+async def start_health_server(port: int) -> web.AppRunner:
+    """Start the aiohttp health check server on the running event loop"""
+    app = web.Application()
+    app.router.add_get('/', health_check)
+    app.router.add_get('/health', health)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    return runner
 
 async def main():
     """Main function to run the bot"""
     
     # Debug: Print all environment variables (for troubleshooting)
-    logger.info("Available environment variables:")
-    for key in sorted(os.environ.keys()):
-        if 'TOKEN' in key or 'CHAT' in key or 'BOT' in key:
-            logger.info(f"  {key}: {'*' * len(str(os.environ[key]))}")
-        elif key in ['PORT', 'PYTHONPATH']:
-            logger.info(f"  {key}: {os.environ[key]}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Available environment variables:")
+        for key in sorted(os.environ.keys()):
+            if 'TOKEN' in key or 'CHAT' in key or 'BOT' in key:
+                logger.debug(f"  {key}: {'*' * len(str(os.environ[key]))}")
+            elif key in ['PORT', 'HEALTH_PORT', 'WEBHOOK_HOST', 'PYTHONPATH']:
+                logger.debug(f"  {key}: {os.environ[key]}")
     
     # Get configuration from environment variables
     BOT_TOKEN = os.environ.get('BOT_TOKEN')
     GROUP_CHAT_ID = os.environ.get('GROUP_CHAT_ID')
+    WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST')
     
     logger.info(f"BOT_TOKEN found: {bool(BOT_TOKEN)}")
     logger.info(f"GROUP_CHAT_ID found: {bool(GROUP_CHAT_ID)}")
+    logger.info(f"WEBHOOK_HOST found: {bool(WEBHOOK_HOST)}")
     
     # Validate configuration
     if not BOT_TOKEN:
@@ -288,10 +305,16 @@ async def main():
         logger.error("❌ GROUP_CHAT_ID must be a valid integer!")
         return
     
-    # Start Flask server in background thread for Koyeb health checks
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info(f"Flask server started on port {os.environ.get('PORT', 8000)}")
+    # In webhook mode Telegram pushes updates to PORT, so the health
+    # server moves to HEALTH_PORT instead
+    if WEBHOOK_HOST:
+        health_port = int(os.environ.get('HEALTH_PORT', PORT + 1))
+    else:
+        health_port = PORT
+    
+    # Start health check server for Koyeb on the same event loop as the bot
+    health_runner = await start_health_server(health_port)
+    logger.info(f"Health server started on port {health_port}")
     
     # Create and run the bot
     bot = TelegramLeaveBot(BOT_TOKEN, group_chat_id)
@@ -303,18 +326,28 @@ async def main():
     logger.info("=" * 50)
     logger.info("✅ Bot is starting...")
     
+    # Park until Koyeb (SIGTERM) or the user (SIGINT) asks us to stop
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+    loop.add_signal_handler(signal.SIGINT, stop_event.set)
+    
     try:
-        await bot.start_bot()
-        # Keep the bot running
-        while True:
-            await asyncio.sleep(60)  # Check every minute
-            logger.info("Bot is running...")
+        await bot.start_bot(webhook_host=WEBHOOK_HOST, port=PORT)
+        await stop_event.wait()
+        logger.info("🛑 Bot stopped by signal")
+        
+        await bot.application.updater.stop()
+        await bot.application.stop()
+        await bot.application.shutdown()
             
-    except KeyboardInterrupt:
-        logger.info("🛑 Bot stopped by user")
     except Exception as e:
         logger.error(f"❌ Error running bot: {e}")
         raise
+    finally:
+        await health_runner.cleanup()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())